@@ -1,81 +1,236 @@
 """the downloader module handles the downloading"""
 
-from multiprocessing.pool import ThreadPool
-from threading import Semaphore
-import urllib.request
+import asyncio
+import atexit
 import io
 import math
-import exifread
-import json
+import os
+import random
+import re
+import ssl
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import piexif
+import orjson
 import time
 import hashlib
 import pyarrow as pa
 import traceback
 
+import aiohttp
 import fsspec
 from .logger import CappedCounter
 from .logger import write_stats
 
+try:
+    import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+# a single SSL context shared by every connection of the process, built once
+_SSL_CONTEXT = ssl.create_default_context()
+
+# one long-lived ClientSession per event loop (so per worker process), reused across shards
+_SESSIONS = weakref.WeakKeyDictionary()
+
+# per-process event loop kept alive across shards so the session survives shard boundaries
+_LOOP = None
+
+# per-process thread pool for the CPU-bound post-processing (resize, exif);
+# OpenCV releases the GIL so it overlaps with the event loop
+_EXECUTOR = None
+
+
+def _get_executor():
+    """Return the per-process post-processing thread pool, creating it on first use"""
+    global _EXECUTOR  # pylint: disable=global-statement
+    if _EXECUTOR is None:
+        _EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+        atexit.register(_EXECUTOR.shutdown)
+    return _EXECUTOR
+
+
+def _get_event_loop():
+    """Return the per-process event loop, creating it on first use"""
+    global _LOOP  # pylint: disable=global-statement
+    if _LOOP is None or _LOOP.is_closed():
+        _LOOP = asyncio.new_event_loop()
+    return _LOOP
+
+
+def _get_session(thread_count):
+    """Return the long-lived session of the running loop, creating it on first use"""
+    loop = asyncio.get_event_loop()
+    session = _SESSIONS.get(loop)
+    if session is None:
+        connector = aiohttp.TCPConnector(
+            limit=thread_count * 2,
+            limit_per_host=8,
+            ttl_dns_cache=300,
+            use_dns_cache=True,
+            force_close=False,
+            enable_cleanup_closed=True,
+            ssl=_SSL_CONTEXT,
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _SESSIONS[loop] = session
+    return session
+
+
+@atexit.register
+def _close_session():
+    """Close the shared session and loop on process shutdown"""
+    loop = _LOOP
+    if loop is None or loop.is_closed():
+        return
+    session = _SESSIONS.pop(loop, None)
+    if session is not None and not session.closed:
+        loop.run_until_complete(session.close())
+    loop.close()
+
+
+# matches one comma-separated directive with its surrounding whitespace stripped
+_ROBOTS_DIRECTIVE_RE = re.compile(r"\s*([^,]*[^,\s])\s*(?:,|$)")
+
+
+def _error_label(err):
+    """Return a stable label for an exception instead of str(err)
+
+    Transport error messages embed hosts, ports and addresses, so counting raw
+    messages gives one counter key per failure and the status counter never
+    aggregates; the exception class name keeps it to a handful of keys.
+    """
+    if isinstance(err, asyncio.TimeoutError):
+        return "timeout"
+    return type(err).__name__
+
 
 def is_disallowed(headers, user_agent_token, disallowed_header_directives):
     """Check if HTTP headers contain an X-Robots-Tag directive disallowing usage"""
-    for values in headers.get_all("X-Robots-Tag", []):
+    for values in headers.getall("X-Robots-Tag", ()):
         try:
-            uatoken_directives = values.split(":", 1)
-            directives = [x.strip().lower() for x in uatoken_directives[-1].split(",")]
-            ua_token = uatoken_directives[0].lower() if len(uatoken_directives) == 2 else None
-            if (ua_token is None or ua_token == user_agent_token) and any(
-                x in disallowed_header_directives for x in directives
-            ):
-                return True
+            # lowercase the whole header once instead of once per token
+            lowered = values.lower()
+            ua_token, sep, directives = lowered.partition(":")
+            if not sep:
+                ua_token, directives = None, lowered
+            else:
+                ua_token = ua_token.strip()
+            if ua_token is None or ua_token == user_agent_token:
+                for match in _ROBOTS_DIRECTIVE_RE.finditer(directives):
+                    if match.group(1) in disallowed_header_directives:
+                        return True
         except Exception as err:  # pylint: disable=broad-except
-            traceback.print_exc()
             print(f"Failed to parse X-Robots-Tag: {values}: {err}")
     return False
 
 
-def download_image(row, timeout, user_agent_token, disallowed_header_directives):
-    """Download an image with urllib"""
+# statuses worth retrying; other HTTP errors (404, 403, ...) are permanent
+_RETRYABLE_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+
+# how many samples are handed to the writer per batch
+_WRITE_BATCH_SIZE = 256
+
+# read size for chunked downloads when the body length is unknown
+_CHUNK_SIZE = 8 * io.DEFAULT_BUFFER_SIZE
+
+
+async def download_image(
+    row, session, timeout, user_agent_token, disallowed_header_directives, compute_hash=None, max_image_bytes=None
+):
+    """Download an image with aiohttp
+
+    Returns (key, img_data, digest, error_message, retryable, retry_after): img_data is
+    the raw downloaded bytes (consumers wrap it themselves, avoiding BytesIO bookkeeping
+    on every sample), retryable tells whether retrying can help, retry_after is the delay
+    (in seconds) requested by the server through the Retry-After header, if any.
+    """
     key, url = row
-    img_stream = None
+    hasher = hashlib.new(compute_hash) if compute_hash is not None else None
     user_agent_string = "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0"
     if user_agent_token:
         user_agent_string += f" (compatible; {user_agent_token}; +https://github.com/rom1504/img2dataset)"
     try:
-        request = urllib.request.Request(url, data=None, headers={"User-Agent": user_agent_string})
-        with urllib.request.urlopen(request, timeout=timeout) as r:
+        async with session.get(
+            url,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            headers={"User-Agent": user_agent_string},
+        ) as resp:
+            if resp.status != 200:
+                retry_after = None
+                if resp.status in (429, 503):
+                    header = resp.headers.get("Retry-After")
+                    if header is not None:
+                        try:
+                            retry_after = min(float(header), 30.0)
+                        except ValueError:
+                            retry_after = None
+                return key, None, None, f"HTTP Error {resp.status}", resp.status in _RETRYABLE_STATUS, retry_after
             if disallowed_header_directives and is_disallowed(
-                r.headers,
+                resp.headers,
                 user_agent_token,
                 disallowed_header_directives,
             ):
-                return key, None, "Use of image disallowed by X-Robots-Tag directive"
-            img_stream = io.BytesIO(r.read())
-        return key, img_stream, None
+                return key, None, None, "Use of image disallowed by X-Robots-Tag directive", False, None
+            content_length = resp.content_length
+            if resp.headers.get("Content-Encoding") is not None:
+                # aiohttp decompresses encoded bodies on the fly, so the advertised
+                # length is the compressed size on the wire, not what resp.content
+                # yields; only trust it for identity responses
+                content_length = None
+            if max_image_bytes is not None and content_length and content_length > max_image_bytes:
+                # reject from the headers alone, before reading a single body byte
+                return key, None, None, "image too large", False, None
+            if content_length:
+                # a single C-level drain of the stream into one pre-sized buffer,
+                # without per-chunk Python accounting
+                buf = await resp.content.readexactly(content_length)
+                if hasher is not None:
+                    hasher.update(buf)
+            else:
+                buf = bytearray()
+                async for chunk in resp.content.iter_chunked(_CHUNK_SIZE):
+                    buf.extend(chunk)
+                    if max_image_bytes is not None and len(buf) > max_image_bytes:
+                        # servers that omit Content-Length still cannot feed us an
+                        # arbitrarily large body
+                        return key, None, None, "image too large", False, None
+                    if hasher is not None:
+                        hasher.update(chunk)
+        return key, buf, hasher.hexdigest() if hasher is not None else None, None, True, None
     except Exception as err:  # pylint: disable=broad-except
-        if img_stream is not None:
-            img_stream.close()
-        return key, None, str(err)
-
+        return key, None, None, _error_label(err), True, None
 
-def download_image_with_retry(row, timeout, retries, user_agent_token, disallowed_header_directives):
-    for _ in range(retries + 1):
-        key, img_stream, err = download_image(row, timeout, user_agent_token, disallowed_header_directives)
-        if img_stream is not None:
-            return key, img_stream, err
-    return key, None, err
 
-
-def compute_key(key, shard_id, oom_sample_per_shard, oom_shard_count):
-    true_key = (10**oom_sample_per_shard) * shard_id + key
-    key_format = oom_sample_per_shard + oom_shard_count
-    str_key = "{true_key:0{key_format}d}".format(  # pylint: disable=consider-using-f-string
-        key_format=key_format, true_key=true_key
-    )
-    return str_key
+async def download_image_with_retry(
+    row,
+    data_queue,
+    session,
+    timeout,
+    retries,
+    user_agent_token,
+    disallowed_header_directives,
+    compute_hash,
+    max_image_bytes,
+):
+    """Download an image, retrying retryable failures, and put the result on data_queue"""
+    # exponential backoff with jitter between attempts: hammering a host that
+    # just rate-limited us only makes the error rate climb over the shard
+    delay = 0.1
+    for attempt in range(retries + 1):
+        key, img_data, digest, err, retryable, retry_after = await download_image(
+            row, session, timeout, user_agent_token, disallowed_header_directives, compute_hash, max_image_bytes
+        )
+        if img_data is not None or not retryable or attempt == retries:
+            break
+        await asyncio.sleep(retry_after if retry_after is not None else delay + random.random() * delay)
+        delay = min(delay * 2, 8.0)
+    await data_queue.put((key, img_data, digest, err))
 
 
-class Downloader:
+class AsyncDownloader:
     """The downloader class gets calls with shards, download them then call the writer to write them down"""
 
     def __init__(
@@ -96,6 +251,7 @@ class Downloader:
         user_agent_token,
         disallowed_header_directives,
         blurring_bbox_col=None,
+        max_image_bytes=32 * 1024 * 1024,
     ) -> None:
         self.sample_writer_class = sample_writer_class
         self.resizer = resizer
@@ -117,6 +273,7 @@ class Downloader:
             else {directive.strip().lower() for directive in disallowed_header_directives}
         )
         self.blurring_bbox_col = blurring_bbox_col
+        self.max_image_bytes = max_image_bytes
 
     def __call__(
         self,
@@ -158,32 +315,21 @@ class Downloader:
         if self.compute_hash is not None:
             schema = schema.append(pa.field(self.compute_hash, pa.string()))
 
+        # keep the columns as parallel lists and index them per row, instead of
+        # materializing one (key, tuple of all columns) pair per row for the whole shard
         pydict = df.select(self.column_list).to_pydict()
-        shard_to_dl = list(enumerate(zip(*(pydict[col] for col in self.column_list))))
-        del pydict
         del df
 
         status_dict = CappedCounter()
 
-        count = len(shard_to_dl)
+        count = len(pydict["url"])
         successes = 0
         failed_to_download = 0
         failed_to_resize = 0
-        url_indice = self.column_list.index("url")
-        caption_indice = self.column_list.index("caption") if "caption" in self.column_list else None
-        bbox_indice = self.column_list.index(self.blurring_bbox_col) if self.blurring_bbox_col is not None else None
-        key_url_list = [(key, x[url_indice]) for key, x in shard_to_dl]
-
-        # this prevents an accumulation of more than twice the number of threads in sample ready to resize
-        # limit the memory usage
-        semaphore = Semaphore(self.thread_count * 2)
-
-        def data_generator():
-            for e in key_url_list:
-                semaphore.acquire()  # pylint: disable=consider-using-with
-                yield e
-
-        loader = data_generator()
+        column_data = [pydict[col] for col in self.column_list]
+        caption_column = pydict["caption"] if "caption" in self.column_list else None
+        bbox_column = pydict[self.blurring_bbox_col] if self.blurring_bbox_col is not None else None
+        url_column = pydict["url"]
 
         # give schema to writer
         sample_writer = self.sample_writer_class(
@@ -195,118 +341,220 @@ class Downloader:
             self.encode_format,
         )
         oom_sample_per_shard = math.ceil(math.log10(self.number_sample_per_shard))
-        with ThreadPool(self.thread_count) as thread_pool:
-            for key, img_stream, error_message in thread_pool.imap_unordered(
-                lambda x: download_image_with_retry(
-                    x,
-                    timeout=self.timeout,
-                    retries=self.retries,
-                    user_agent_token=self.user_agent_token,
-                    disallowed_header_directives=self.disallowed_header_directives,
-                ),
-                loader,
+        # both are constant over the shard: computing the offset and padding width once
+        # replaces a compute_key call (exponentiation + dynamic format spec) per sample
+        shard_offset = (10**oom_sample_per_shard) * shard_id
+        key_width = oom_sample_per_shard + self.oom_shard_count
+        # pyarrow rebuilds the names list on every .names access, so fetch it once
+        schema_names = tuple(schema.names)
+
+        async def run():
+            nonlocal successes, failed_to_download, failed_to_resize
+
+            loop = asyncio.get_event_loop()
+            executor = _get_executor()
+            session = _get_session(self.thread_count)
+            # bounded so downloaders pause once the saver falls behind, keeping memory O(threads)
+            # instead of O(shard) when resizing is the bottleneck
+            data_queue = asyncio.Queue(maxsize=self.thread_count * 2)
+
+            async def download_worker(url_queue):
+                while True:
+                    row = await url_queue.get()
+                    try:
+                        await download_image_with_retry(
+                            row,
+                            data_queue,
+                            session,
+                            timeout=self.timeout,
+                            retries=self.retries,
+                            user_agent_token=self.user_agent_token,
+                            disallowed_header_directives=self.disallowed_header_directives,
+                            compute_hash=self.compute_hash,
+                            max_image_bytes=self.max_image_bytes,
+                        )
+                    finally:
+                        url_queue.task_done()
+
+            async def download_task():
+                # a fixed pool of worker coroutines pulling from a queue bounds concurrency
+                # without acquiring a semaphore per url and without one task per url;
+                # the queue is bounded and fed lazily so pending work stays O(threads)
+                # rather than one queue entry per row of the shard
+                url_queue = asyncio.Queue(maxsize=self.thread_count * 2)
+                workers = [asyncio.ensure_future(download_worker(url_queue)) for _ in range(self.thread_count)]
+                for x in enumerate(url_column):
+                    await url_queue.put(x)
+                await url_queue.join()
+                for worker in workers:
+                    worker.cancel()
+                await data_queue.put(("finish", "finish", "finish", "finish"))
+
+            def make_meta(
+                sample_data,
+                str_key,
+                status,
+                error_message,
+                width,
+                height,
+                original_width,
+                original_height,
+                exif,
+                digest,
             ):
-                try:
-                    _, sample_data = shard_to_dl[key]
-                    str_key = compute_key(key, shard_id, oom_sample_per_shard, self.oom_shard_count)
-                    meta = {
-                        **{self.column_list[i]: sample_data[i] for i in range(len(self.column_list))},
-                        "key": str_key,
-                        "status": None,
-                        "error_message": error_message,
-                        "width": None,
-                        "height": None,
-                        "original_width": None,
-                        "original_height": None,
-                    }
-                    if self.extract_exif:
-                        meta["exif"] = None
-                    if self.compute_hash is not None:
-                        meta[self.compute_hash] = None
-                    if error_message is not None:
-                        failed_to_download += 1
-                        status = "failed_to_download"
-                        status_dict.increment(error_message)
-                        meta["status"] = status
-                        sample_writer.write(
-                            None,
+                """Assemble the meta dict from a schema-ordered value tuple in a single C-level dict(zip())"""
+                values = sample_data + (
+                    str_key,
+                    status,
+                    error_message,
+                    width,
+                    height,
+                    original_width,
+                    original_height,
+                )
+                if self.extract_exif:
+                    values += (exif,)
+                if self.compute_hash is not None:
+                    values += (digest,)
+                return dict(zip(schema_names, values))
+
+            def postprocess(img_data, bbox_list):
+                """Resize and extract EXIF in a single executor hop, off the event loop"""
+                # the resizer expects a stream; this is the only wrapping of the raw bytes
+                img, width, height, original_width, original_height, error_message = self.resizer(
+                    io.BytesIO(img_data), bbox_list
+                )
+                exif = None
+                if self.extract_exif and error_message is None:
+                    try:
+                        # piexif jumps straight to the APP1 segment instead of
+                        # walking every marker of the file like exifread did
+                        exif_data = piexif.load(img_data, key_is_name=True)
+                        tags = {}
+                        for ifd_name, ifd in exif_data.items():
+                            if not isinstance(ifd, dict):
+                                continue
+                            for tag_name, value in ifd.items():
+                                if isinstance(value, bytes):
+                                    value = value.decode("utf-8", "replace")
+                                tags[f"{ifd_name} {tag_name}"] = str(value).strip()
+                        exif = orjson.dumps(tags).decode()
+                    except Exception as _:  # pylint: disable=broad-except
+                        exif = None
+                return img, width, height, original_width, original_height, error_message, exif
+
+            def write_batch(samples):
+                """Write a batch of samples in one tight loop, off the event loop"""
+                # a failing write must not abort the batch (let alone the shard),
+                # so errors are caught per sample like they always were
+                for img, str_key, caption, meta in samples:
+                    try:
+                        sample_writer.write(img, str_key, caption, meta)
+                    except Exception as err:  # pylint: disable=broad-except
+                        traceback.print_exc()
+                        print(f"Sample {str_key} failed to write: {err}")
+
+            async def save_task():
+                nonlocal successes, failed_to_download, failed_to_resize
+                # samples are buffered and written in batches: the writers do blocking
+                # file/tar I/O, so batching both amortizes the per-call overhead and
+                # keeps that I/O in the executor instead of on the event loop
+                pending = []
+                error_count = 0
+                while True:
+                    key, img_data, digest, error_message = await data_queue.get()
+                    if key == "finish":
+                        break
+                    if len(pending) >= _WRITE_BATCH_SIZE:
+                        batch, pending = pending, []
+                        await loop.run_in_executor(executor, write_batch, batch)
+                    try:
+                        sample_data = tuple(col[key] for col in column_data)
+                        str_key = f"{shard_offset + key:0{key_width}d}"
+                        caption = caption_column[key] if caption_column is not None else None
+                        if error_message is not None:
+                            failed_to_download += 1
+                            status_dict.increment(error_message)
+                            meta = make_meta(
+                                sample_data,
+                                str_key,
+                                "failed_to_download",
+                                error_message,
+                                None,
+                                None,
+                                None,
+                                None,
+                                None,
+                                None,
+                            )
+                            pending.append((None, str_key, caption, meta))
+                            continue
+                        bbox_list = bbox_column[key] if bbox_column is not None else None
+                        (
+                            img,
+                            width,
+                            height,
+                            original_width,
+                            original_height,
+                            error_message,
+                            exif,
+                        ) = await loop.run_in_executor(executor, postprocess, img_data, bbox_list)
+                        if error_message is not None:
+                            failed_to_resize += 1
+                            status_dict.increment(error_message)
+                            meta = make_meta(
+                                sample_data,
+                                str_key,
+                                "failed_to_resize",
+                                error_message,
+                                None,
+                                None,
+                                None,
+                                None,
+                                None,
+                                None,
+                            )
+                            pending.append((None, str_key, caption, meta))
+                            del img_data
+                            continue
+                        successes += 1
+                        status_dict.increment("success")
+                        del img_data
+
+                        meta = make_meta(
+                            sample_data,
                             str_key,
-                            sample_data[caption_indice] if caption_indice is not None else None,
-                            meta,
-                        )
-                        semaphore.release()
-                        continue
-                    img_stream.seek(0)
-                    bbox_list = sample_data[bbox_indice] if bbox_indice is not None else None
-                    (
-                        img,
-                        width,
-                        height,
-                        original_width,
-                        original_height,
-                        error_message,
-                    ) = self.resizer(img_stream, bbox_list)
-                    if error_message is not None:
-                        failed_to_resize += 1
-                        status = "failed_to_resize"
-                        status_dict.increment(error_message)
-                        meta["status"] = status
-                        meta["error_message"] = error_message
-                        sample_writer.write(
+                            "success",
                             None,
-                            str_key,
-                            sample_data[caption_indice] if caption_indice is not None else None,
-                            meta,
+                            width,
+                            height,
+                            original_width,
+                            original_height,
+                            exif,
+                            digest,
                         )
-                        img_stream.close()
-                        del img_stream
-                        semaphore.release()
-                        continue
-                    successes += 1
-                    status = "success"
-                    status_dict.increment(status)
-
-                    if self.extract_exif:
-                        try:
-                            img_stream.seek(0)
-                            exif = json.dumps(
-                                {
-                                    k: str(v).strip()
-                                    for k, v in exifread.process_file(img_stream, details=False).items()
-                                    if v is not None
-                                }
-                            )
-                        except Exception as _:  # pylint: disable=broad-except
-                            exif = None
-                        meta["exif"] = exif
-
-                    if self.compute_hash is not None:
-                        img_stream.seek(0)
-                        meta[self.compute_hash] = getattr(hashlib, self.compute_hash)(img_stream.read()).hexdigest()
-
-                    meta["status"] = status
-                    meta["width"] = width
-                    meta["height"] = height
-                    meta["original_width"] = original_width
-                    meta["original_height"] = original_height
-                    img_stream.close()
-                    del img_stream
-
-                    sample_writer.write(
-                        img,
-                        str_key,
-                        sample_data[caption_indice] if caption_indice is not None else None,
-                        meta,
-                    )
-                except Exception as err:  # pylint: disable=broad-except
-                    traceback.print_exc()
-                    print(f"Sample {key} failed to download: {err}")
-                semaphore.release()
-
-            sample_writer.close()
-            thread_pool.terminate()
-            thread_pool.join()
-            del thread_pool
+                        pending.append((img, str_key, caption, meta))
+                    except Exception as err:  # pylint: disable=broad-except
+                        # formatting tracebacks blocks the event loop, so under an error
+                        # storm only the first one is printed in full and the one-liners
+                        # stop after a handful
+                        error_count += 1
+                        if error_count <= 10:
+                            print(f"Sample {key} failed to download: {err}")
+                            if error_count == 1:
+                                traceback.print_exc()
+                            if error_count == 10:
+                                print("further sample errors in this shard will not be printed")
+                if pending:
+                    await loop.run_in_executor(executor, write_batch, pending)
+
+            await asyncio.gather(download_task(), save_task())
+
+        loop = _get_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(run())
+
+        sample_writer.close()
 
         end_time = time.time()
         write_stats(
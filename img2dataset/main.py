@@ -2,7 +2,6 @@
 
 from typing import List, Optional
 import fire
-import logging
 from .logger import LoggerProcess
 from .resizer import Resizer
 from .blurrer import BoundingBoxBlurrer
@@ -14,15 +13,13 @@ from .writer import (
     DummySampleWriter,
 )
 from .reader import Reader
-from .downloader import Downloader
+from .downloader import AsyncDownloader
 from .distributor import multiprocessing_distributor, pyspark_distributor
 import fsspec
 import sys
 import signal
 import os
 
-logging.getLogger("exifread").setLevel(level=logging.CRITICAL)
-
 
 def arguments_validator(params):
     """Validate the arguments"""
@@ -95,6 +92,7 @@ def download(
     max_shard_retry: int = 1,
     user_agent_token: Optional[str] = None,
     disallowed_header_directives: Optional[List[str]] = None,
+    max_image_bytes: int = 32 * 1024 * 1024,
 ):
     """Download is the main entry point of img2dataset, it uses multiple processes and download multiple files"""
     if disallowed_header_directives is None:
@@ -202,7 +200,7 @@ def download(
         blurrer=blurrer,
     )
 
-    downloader = Downloader(
+    downloader = AsyncDownloader(
         sample_writer_class=sample_writer_class,
         resizer=resizer,
         thread_count=thread_count,
@@ -219,6 +217,7 @@ def download(
         user_agent_token=user_agent_token,
         disallowed_header_directives=disallowed_header_directives,
         blurring_bbox_col=bbox_col,
+        max_image_bytes=max_image_bytes,
     )
 
     print("Starting the downloading of this file")
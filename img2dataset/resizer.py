@@ -7,6 +7,15 @@ from enum import Enum
 import imghdr
 import os
 
+# reduced-scale decoding flags: libjpeg scales during the IDCT, making a 1/2, 1/4
+# or 1/8 decode much cheaper than decoding full size then resizing
+_REDUCED_COLOR_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+_REDUCED_GRAYSCALE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
 _INTER_STR_TO_CV2 = dict(
     nearest=cv2.INTER_NEAREST,
     linear=cv2.INTER_LINEAR,
@@ -59,6 +68,30 @@ class SuppressStdoutStderr:
             os.close(fd)
 
 
+def jpeg_header(data):
+    """Parse (width, height, components) from the SOF marker of a JPEG, None if not a parsable JPEG"""
+    if data[:2] != b"\xff\xd8":
+        return None
+    idx = 2
+    size = len(data)
+    while idx + 9 < size:
+        if data[idx] != 0xFF:
+            return None
+        marker = data[idx + 1]
+        if marker == 0xFF:
+            idx += 1
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[idx + 5 : idx + 7], "big")
+            width = int.from_bytes(data[idx + 7 : idx + 9], "big")
+            return width, height, data[idx + 9]
+        if marker == 0xD8 or 0xD0 <= marker <= 0xD7:
+            idx += 2
+            continue
+        idx += 2 + int.from_bytes(data[idx + 2 : idx + 4], "big")
+    return None
+
+
 def inter_str_to_cv2(inter_str):
     inter_str = inter_str.lower()
     if inter_str not in _INTER_STR_TO_CV2:
@@ -147,8 +180,28 @@ class Resizer:
                 img_stream.seek(0)
                 encode_needed = imghdr.what(img_stream) != self.what_ext if self.skip_reencode else True
                 img_stream.seek(0)
-                img_buf = np.frombuffer(img_stream.read(), np.uint8)
-                img = cv2.imdecode(img_buf, cv2.IMREAD_UNCHANGED)
+                img_bytes = img_stream.read()
+                img_buf = np.frombuffer(img_bytes, np.uint8)
+                imread_flags = cv2.IMREAD_UNCHANGED
+                original_size = None
+                if self.resize_mode != ResizeMode.no:
+                    header = jpeg_header(img_bytes)
+                    if header is not None:
+                        header_width, header_height, components = header
+                        if self.resize_mode in (ResizeMode.keep_ratio, ResizeMode.center_crop):
+                            determining_side = min(header_width, header_height)
+                        else:
+                            determining_side = max(header_width, header_height)
+                        # decode at the largest reduction that still leaves at least 2x the
+                        # target on the side driving the resize, so quality is unaffected
+                        factor = 1
+                        while factor < 8 and determining_side // (factor * 2) >= 2 * self.image_size:
+                            factor *= 2
+                        if factor > 1:
+                            reduced_flags = _REDUCED_GRAYSCALE_FLAGS if components == 1 else _REDUCED_COLOR_FLAGS
+                            imread_flags = reduced_flags[factor]
+                            original_size = (header_width, header_height)
+                img = cv2.imdecode(img_buf, imread_flags)
                 if img is None:
                     raise Exception("Image decoding error")
                 if len(img.shape) == 3 and img.shape[-1] == 4:
@@ -157,7 +210,10 @@ class Resizer:
                     img = alpha / 255 * img[..., :3] + 255 - alpha
                     img = np.rint(img.clip(min=0, max=255)).astype(np.uint8)
                     encode_needed = True
-                original_height, original_width = img.shape[:2]
+                if original_size is not None:
+                    original_width, original_height = original_size
+                else:
+                    original_height, original_width = img.shape[:2]
                 # check if image is too small
                 if min(original_height, original_width) < self.min_image_size:
                     return None, None, None, None, None, "image too small"
@@ -210,9 +266,12 @@ class Resizer:
 
                 height, width = img.shape[:2]
                 if encode_needed:
-                    img_str = cv2.imencode(f".{self.encode_format}", img, params=self.encode_params)[1].tobytes()
+                    # hand out a zero-copy view of the encoder's output buffer; writers
+                    # that need a real bytes object convert once on their side
+                    encoded = cv2.imencode(f".{self.encode_format}", img, params=self.encode_params)[1]
+                    img_str = encoded.data
                 else:
-                    img_str = img_buf.tobytes()
+                    img_str = img_bytes
                 return img_str, width, height, original_width, original_height, None
 
         except Exception as err:  # pylint: disable=broad-except
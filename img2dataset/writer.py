@@ -78,7 +78,8 @@ class ParquetSampleWriter:
     def write(self, img_str, key, caption, meta):
         """Keep sample in memory then write to disk when close() is called"""
         if img_str is not None:
-            sample = {"key": key, self.encode_format: img_str}
+            # the resizer may hand out a memoryview; arrow needs a real bytes object
+            sample = {"key": key, self.encode_format: bytes(img_str)}
             if self.save_caption:
                 sample["txt"] = str(caption) if caption is not None else ""
         else:
@@ -119,7 +120,8 @@ class WebDatasetSampleWriter:
     def write(self, img_str, key, caption, meta):
         """write sample to tars"""
         if img_str is not None:
-            sample = {"__key__": key, self.encode_format: img_str}
+            # the resizer may hand out a memoryview; the tar writer needs a real bytes object
+            sample = {"__key__": key, self.encode_format: bytes(img_str)}
             if self.save_caption:
                 sample["txt"] = str(caption) if caption is not None else ""
             # some meta data may not be JSON serializable
@@ -219,6 +221,8 @@ class TFRecordSampleWriter:
             value = ""
         if isinstance(value, str):
             value = value.encode()
+        elif isinstance(value, memoryview):
+            value = bytes(value)
         return self._Feature(bytes_list=self._BytesList(value=[value]))
 
     def _float_feature(self, value):
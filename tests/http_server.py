@@ -1,6 +1,7 @@
 import os
 
 from fastapi import FastAPI, Response
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 
 
@@ -16,11 +17,30 @@ app = FastAPI()
 current_folder = os.path.dirname(__file__)
 test_folder = str(current_folder) + "/" + "resize_test_image"
 
+hit_count = {"large_stream": 0}
+
 
 @app.get("/")
 async def get():
     return "hi"
 
 
+@app.get("/large_stream")
+async def large_stream():
+    # a large body served chunked, so there is no Content-Length to reject from
+    hit_count["large_stream"] += 1
+
+    def body():
+        for _ in range(256):
+            yield b"\x00" * 1024
+
+    return StreamingResponse(body(), media_type="image/jpeg")
+
+
+@app.get("/large_stream_hits")
+async def large_stream_hits():
+    return hit_count["large_stream"]
+
+
 app.mount("/allowed", StaticFiles(directory=test_folder), name="static_allowed")
 app.mount("/disallowed", StaticFilesXRobotsTagHeader(directory=test_folder), name="static_disallowed")
@@ -4,9 +4,11 @@ import json
 from fixtures import setup_fixtures
 from img2dataset.resizer import Resizer
 from img2dataset.writer import FilesSampleWriter
-from img2dataset.downloader import Downloader
+from img2dataset.downloader import AsyncDownloader
 
 import os
+import sys
+import urllib.request
 import pandas as pd
 
 
@@ -24,7 +26,7 @@ def test_valid_hash(compute_hash, tmp_path):
     resizer = Resizer(256, "border", False)
     writer = FilesSampleWriter
 
-    downloader = Downloader(
+    downloader = AsyncDownloader(
         writer,
         resizer,
         thread_count=32,
@@ -72,7 +74,7 @@ def test_unique_hash(compute_hash, tmp_path):
     resizer = Resizer(256, "border", False)
     writer = FilesSampleWriter
 
-    downloader = Downloader(
+    downloader = AsyncDownloader(
         writer,
         resizer,
         thread_count=32,
@@ -122,7 +124,7 @@ def test_downloader(tmp_path):
     resizer = Resizer(256, "border", False)
     writer = FilesSampleWriter
 
-    downloader = Downloader(
+    downloader = AsyncDownloader(
         writer,
         resizer,
         thread_count=32,
@@ -147,3 +149,51 @@ def test_downloader(tmp_path):
     downloader((0, tmp_file))
 
     assert len(os.listdir(image_folder_name + "/00000")) == 3 * n_allowed
+
+
+def test_max_image_bytes(tmp_path):
+    test_folder = str(tmp_path)
+    port = f"123{sys.version_info.minor}"
+    test_list = setup_fixtures(count=2, disallowed=0)
+    # the static files advertise a Content-Length while /large_stream is chunked,
+    # covering both the header-based reject and the mid-stream abort
+    test_list.append(("streamed", f"http://localhost:{port}/large_stream"))
+
+    image_folder_name = os.path.join(test_folder, "images")
+    os.mkdir(image_folder_name)
+
+    resizer = Resizer(256, "border", False)
+    writer = FilesSampleWriter
+
+    downloader = AsyncDownloader(
+        writer,
+        resizer,
+        thread_count=32,
+        save_caption=True,
+        extract_exif=True,
+        output_folder=image_folder_name,
+        column_list=["caption", "url"],
+        timeout=10,
+        number_sample_per_shard=10,
+        oom_shard_count=5,
+        compute_hash="md5",
+        encode_format="jpg",
+        retries=2,
+        user_agent_token="img2dataset",
+        disallowed_header_directives=["noai", "noindex"],
+        max_image_bytes=1000,
+    )
+
+    tmp_file = os.path.join(test_folder, "test_list.feather")
+    df = pd.DataFrame(test_list, columns=["caption", "url"])
+    df.to_feather(tmp_file)
+
+    downloader((0, tmp_file))
+
+    df = pd.read_parquet(image_folder_name + "/00000.parquet")
+    assert (df["status"] == "failed_to_download").all()
+    assert (df["error_message"] == "image too large").all()
+
+    # oversize is a permanent failure: the streamed url must not have been retried
+    hits = json.loads(urllib.request.urlopen(f"http://localhost:{port}/large_stream_hits").read())
+    assert hits == 1
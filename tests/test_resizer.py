@@ -1,4 +1,4 @@
-from img2dataset.resizer import Resizer
+from img2dataset.resizer import Resizer, jpeg_header
 import os
 import glob
 import pytest
@@ -65,6 +65,36 @@ def test_resizer(image_size, resize_mode, resize_only_if_bigger, skip_reencode,
         check_one_image_size(image_resized, image_original, image_size, resize_mode, resize_only_if_bigger)
 
 
+def test_jpeg_header():
+    img = np.zeros((200, 300, 3), dtype=np.uint8)
+    color = cv2.imencode(".jpg", img)[1].tobytes()
+    assert jpeg_header(color) == (300, 200, 3)
+    grayscale = cv2.imencode(".jpg", np.zeros((64, 128), dtype=np.uint8))[1].tobytes()
+    assert jpeg_header(grayscale) == (128, 64, 1)
+    progressive = cv2.imencode(".jpg", img, [int(cv2.IMWRITE_JPEG_PROGRESSIVE), 1])[1].tobytes()
+    assert jpeg_header(progressive) == (300, 200, 3)
+    png = cv2.imencode(".png", img)[1].tobytes()
+    assert jpeg_header(png) is None
+    assert jpeg_header(color[:10]) is None
+
+
+@pytest.mark.parametrize("grayscale", [False, True])
+@pytest.mark.parametrize("resize_mode", ["border", "keep_ratio"])
+def test_resizer_reduced_decode(grayscale, resize_mode):
+    # the checked-in test images are all below the reduced-scale decode threshold,
+    # so generate a jpeg large enough to exercise it
+    shape = (2000, 3000) if grayscale else (2000, 3000, 3)
+    img = np.random.randint(0, 255, shape, dtype=np.uint8)
+    img_bytes = cv2.imencode(".jpg", img)[1].tobytes()
+    resizer = Resizer(256, resize_mode, False)
+    image_resized_str, width, height, original_width, original_height, err = resizer(io.BytesIO(img_bytes))
+    assert err is None
+    assert (original_width, original_height) == (3000, 2000)
+    image_resized = cv2.imdecode(np.frombuffer(image_resized_str, np.uint8), cv2.IMREAD_UNCHANGED)
+    assert (image_resized.shape[1], image_resized.shape[0]) == (width, height)
+    check_one_image_size(image_resized, img, 256, resize_mode, False)
+
+
 def test_resizer_filter():
     current_folder = os.path.dirname(__file__)
     test_folder = current_folder + "/" + "resize_test_image"